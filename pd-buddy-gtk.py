@@ -1,6 +1,11 @@
 #!/usr/bin/env python3
 
 import sys
+import os
+import json
+import tempfile
+import types
+from collections import namedtuple
 
 import pdbuddy
 import gi
@@ -252,6 +257,227 @@ class PDOListRow(Gtk.ListBoxRow):
         self.show_all()
 
 
+# The current (mA) the Sink firmware requests when it can't get what it wants
+DPM_MIN_CURRENT = 100
+# The least Type-C Current (mA) the Sink firmware will turn its output on for
+DPM_MIN_TYPEC_CURRENT = 1500
+
+
+class NegotiationPrediction(namedtuple("NegotiationPrediction",
+        "index pdo v i mismatch")):
+    """The Request a Sink is expected to send in response to some
+    Source_Capabilities
+
+    index is the position of the requested PDO in the Source_Capabilities, v
+    and i are the requested voltage (mV) and current (mA), and mismatch is
+    True if the Sink's configuration can't be satisfied.
+    """
+    __slots__ = ()
+
+
+def required_current(cfg, mv):
+    """Get the current in mA that cfg needs when supplied with mv millivolts
+
+    cfg must not be a zero resistance.
+    """
+    if cfg.idim == pdbuddy.SinkDimension.POWER:
+        return cfg.i * 1000 / mv
+    elif cfg.idim == pdbuddy.SinkDimension.RESISTANCE:
+        return mv * 1000 / cfg.i
+    return cfg.i
+
+
+class SourceCapIndex:
+    """Source_Capabilities arranged for request prediction
+
+    The PDOs are sorted by type once so that each prediction only looks at the
+    PDOs that could possibly be requested.  Within each type they are checked
+    in the same order as the PD Buddy Sink firmware does.
+    """
+
+    def __init__(self, caps):
+        self.caps = list(caps)
+        self.typec = None
+        self.fixed = []
+        self.pps = []
+
+        for index, pdo in enumerate(self.caps):
+            if pdo.pdo_type == "fixed":
+                self.fixed.append((index, pdo))
+            elif pdo.pdo_type == "pps":
+                self.pps.append((index, pdo))
+            elif pdo.pdo_type == "typec_virtual":
+                self.typec = pdo
+
+    def predict(self, cfg):
+        """Predict the request the Sink would make with configuration cfg
+
+        Returns None if there are no capabilities to choose from.
+        """
+        if not self.caps:
+            return None
+
+        # No source can supply a zero resistance
+        if cfg.idim == pdbuddy.SinkDimension.RESISTANCE and not cfg.i:
+            return self._mismatch()
+
+        # Type-C Current can only give us 5 V, and there's no Request to
+        # make, so report what the Sink would draw.  Default USB Power is
+        # never enough.
+        if self.typec is not None:
+            current = required_current(cfg, 5000)
+            return NegotiationPrediction(0, self.typec, 5000, current,
+                    cfg.v != 5000
+                    or self.typec.i < DPM_MIN_TYPEC_CURRENT
+                    or self.typec.i < current)
+
+        # A fixed PDO at exactly the desired voltage.  The firmware compares
+        # voltages in 50 mV units.
+        for index, pdo in self.fixed:
+            if pdo.v // 50 == cfg.v // 50:
+                current = required_current(cfg, pdo.v)
+                if pdo.i >= current:
+                    return NegotiationPrediction(index, pdo, pdo.v, current,
+                                                 False)
+
+        # A PPS APDO whose range includes the desired voltage
+        if cfg.v:
+            current = required_current(cfg, cfg.v)
+            for index, pdo in self.pps:
+                if pdo.vmin <= cfg.v <= pdo.vmax and pdo.i >= current:
+                    return NegotiationPrediction(index, pdo, cfg.v, current,
+                                                 False)
+
+        # A fixed PDO in the voltage range, searching from the high end if
+        # higher voltages are preferred
+        if cfg.vmin and cfg.vmax:
+            if cfg.flags & pdbuddy.SinkFlags.HV_PREFERRED:
+                candidates = reversed(self.fixed)
+            else:
+                candidates = self.fixed
+            for index, pdo in candidates:
+                current = required_current(cfg, pdo.v)
+                if cfg.vmin <= pdo.v <= cfg.vmax and pdo.i >= current:
+                    return NegotiationPrediction(index, pdo, pdo.v, current,
+                                                 False)
+
+        return self._mismatch()
+
+    def _mismatch(self):
+        """Predict the request made when nothing satisfies the Sink, which is
+        vSafe5V at minimum current"""
+        pdo = self.caps[0]
+        return NegotiationPrediction(0, pdo, getattr(pdo, "v", 5000),
+                DPM_MIN_CURRENT, True)
+
+
+class SourceCapLibrary:
+    """Source_Capabilities captured from every source seen, stored on disk"""
+
+    def __init__(self, path):
+        self.path = path
+        self._indices = {}
+
+    @staticmethod
+    def _key(pdo_dicts):
+        return json.dumps(pdo_dicts, sort_keys=True)
+
+    def load(self):
+        """Load the library from disk, starting empty if there isn't one"""
+        try:
+            with open(self.path) as f:
+                library = json.load(f)
+        except FileNotFoundError:
+            return
+
+        if not isinstance(library, list):
+            raise ValueError("Source_Capabilities library is not a list")
+
+        # Build a fresh set of indices, skipping any damaged entries
+        indices = {}
+        for pdo_dicts in library:
+            if (not isinstance(pdo_dicts, list) or not pdo_dicts
+                    or not all(map(self._valid_pdo, pdo_dicts))):
+                continue
+            caps = [types.SimpleNamespace(**d) for d in pdo_dicts]
+            indices[self._key(pdo_dicts)] = SourceCapIndex(caps)
+
+        self._indices = indices
+
+    @staticmethod
+    def _valid_pdo(pdo_dict):
+        """Check that a stored PDO has everything a prediction needs"""
+        fields = {
+            "fixed": ("v", "i"),
+            "pps": ("vmin", "vmax", "i"),
+            "typec_virtual": ("i",),
+            "unknown": ()
+        }
+        if not isinstance(pdo_dict, dict):
+            return False
+        try:
+            required = fields[pdo_dict.get("pdo_type")]
+        except (KeyError, TypeError):
+            return False
+        # Voltages must be positive since we divide by them
+        return all(isinstance(pdo_dict.get(field), int)
+                   and not isinstance(pdo_dict.get(field), bool)
+                   and pdo_dict[field] >= (0 if field == "i" else 1)
+                   for field in required)
+
+    def save(self):
+        """Write the library to disk"""
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+
+        # Write to a temporary file first so an interrupted write can't
+        # truncate the library
+        with tempfile.NamedTemporaryFile("w", dir=directory, suffix=".tmp",
+                                         delete=False) as f:
+            try:
+                json.dump([json.loads(key) for key in self._indices], f,
+                          indent=1)
+            except:
+                f.close()
+                os.remove(f.name)
+                raise
+        try:
+            # Keep the library's permissions, or follow the umask for a new
+            # one, rather than the temporary file's private mode
+            try:
+                mode = os.stat(self.path).st_mode & 0o777
+            except FileNotFoundError:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(f.name, mode)
+            os.replace(f.name, self.path)
+        except OSError:
+            os.remove(f.name)
+            raise
+
+    def add(self, caps):
+        """Add a list of PDOs to the library
+
+        Returns True if they weren't already in it.
+        """
+        pdo_dicts = [dict(pdo._asdict(), pdo_type=pdo.pdo_type)
+                     for pdo in caps]
+        key = self._key(pdo_dicts)
+        if not caps or key in self._indices:
+            return False
+
+        self._indices[key] = SourceCapIndex(caps)
+        return True
+
+    def __len__(self):
+        return len(self._indices)
+
+    def predict(self, cfg):
+        """Predict the request cfg would make of every source in the library"""
+        return [index.predict(cfg) for index in self._indices.values()]
+
+
 class Handler:
 
     def __init__(self, builder):
@@ -259,6 +485,23 @@ class Handler:
         self.serial_port = None
         self.vrange_set = False
         self.selectlist = None
+        self.caps_index = None
+
+        self.library = SourceCapLibrary(os.path.join(GLib.get_user_data_dir(),
+                "pd-buddy-gtk", "source-caps.json"))
+        self.library_writable = True
+        try:
+            self.library.load()
+        except ValueError:
+            # Move a damaged library aside so saving new sources doesn't
+            # overwrite the ones we couldn't read
+            try:
+                os.replace(self.library.path, self.library.path + ".bad")
+            except OSError:
+                self.library_writable = False
+        except OSError:
+            # We couldn't read the library, so don't replace it
+            self.library_writable = False
 
     def on_pdb_window_realize(self, *args):
         # Get the list
@@ -322,6 +565,9 @@ class Handler:
             comms_error_dialog(window, e)
             return
 
+        # Forget the previous device's source until we ask for this one's
+        self.caps_index = None
+
         self._store_device_settings()
         self._set_save_button_visibility()
 
@@ -352,6 +598,7 @@ class Handler:
                 output.set_state(pdbs.output)
         except KeyError:
             pd_frame.set_visible(False)
+            self._set_negotiation_prediction()
         else:
             pd_frame.set_visible(True)
 
@@ -373,6 +620,16 @@ class Handler:
             cap_row.set_activatable(caps)
             cap_arrow.set_visible(caps)
 
+            # Remember the capabilities so we can predict the negotiation
+            # without asking the device again
+            self.caps_index = SourceCapIndex(caps)
+            if self.library.add(caps) and self.library_writable:
+                try:
+                    self.library.save()
+                except OSError:
+                    pass
+            self._set_negotiation_prediction()
+
         # Show the Sink page
         hst = self.builder.get_object("header-stack")
         hsink = self.builder.get_object("header-sink")
@@ -441,10 +698,38 @@ class Handler:
         # Set visibility
         rev.set_reveal_child(self.cfg != self.cfg_clean)
 
+    def _set_negotiation_prediction(self):
+        """Show what the Sink would request from the source with the current
+        settings"""
+        # Get relevant widgets
+        row = self.builder.get_object("negotiation-row")
+        label = self.builder.get_object("negotiation-label")
+        warning = self.builder.get_object("negotiation-warning")
+
+        if self.caps_index is None:
+            row.set_visible(False)
+            return
+
+        prediction = self.caps_index.predict(self.cfg)
+        if prediction is None:
+            row.set_visible(False)
+            return
+        row.set_visible(True)
+
+        label.set_text("{:g} V, {:g} A".format(prediction.v / 1000.0,
+                round(prediction.i / 1000.0, 2)))
+        warning.set_visible(prediction.mismatch)
+
+        # Summarize how the settings would fare with every known source
+        satisfied = sum(not p.mismatch for p in self.library.predict(self.cfg))
+        label.set_tooltip_text("Satisfied by {} of {} known sources".format(
+                satisfied, len(self.library)))
+
     def on_voltage_adjustment_value_changed(self, adj):
         self.cfg = self.cfg._replace(v=int(adj.get_value() * 1000))
 
         self._set_save_button_visibility()
+        self._set_negotiation_prediction()
 
     def on_vrange_switch_state_set(self, switch, state):
         row = self.builder.get_object("vrange-row")
@@ -460,6 +745,7 @@ class Handler:
         self.vrange_set = False
 
         self._set_save_button_visibility()
+        self._set_negotiation_prediction()
 
     def on_vmin_adjustment_value_changed(self, adj):
         if not self.vrange_set:
@@ -471,6 +757,7 @@ class Handler:
                 vmax_adj.set_value(adj.get_value())
 
             self._set_save_button_visibility()
+            self._set_negotiation_prediction()
 
     def on_vmax_adjustment_value_changed(self, adj):
         if not self.vrange_set:
@@ -482,6 +769,7 @@ class Handler:
                 vmin_adj.set_value(adj.get_value())
 
             self._set_save_button_visibility()
+            self._set_negotiation_prediction()
 
     def on_hv_preferred_button_clicked(self, button):
         self.cfg = self.cfg._replace(
@@ -489,6 +777,7 @@ class Handler:
 
         self._set_hv_pref_image()
         self._set_save_button_visibility()
+        self._set_negotiation_prediction()
 
     def _set_hv_pref_image(self):
         hv_pref = self.builder.get_object("hv-preferred-button")
@@ -535,11 +824,13 @@ class Handler:
         self.cfg = self.cfg._replace(idim=idim)
 
         self._set_save_button_visibility()
+        self._set_negotiation_prediction()
 
     def on_current_adjustment_value_changed(self, adj):
         self.cfg = self.cfg._replace(i=int(adj.get_value() * 1000))
 
         self._set_save_button_visibility()
+        self._set_negotiation_prediction()
 
     def on_giveback_switch_state_set(self, switch, state):
         if state:
@@ -548,6 +839,7 @@ class Handler:
             self.cfg = self.cfg._replace(flags=self.cfg.flags&~pdbuddy.SinkFlags.GIVEBACK)
 
         self._set_save_button_visibility()
+        self._set_negotiation_prediction()
 
     def on_output_switch_state_set(self, switch, state):
         with pdbuddy.Sink(self.serial_port) as pdbs: